@@ -25,4 +25,5 @@ __version__ = '0.1.dev0'
 
 from . io import read_log, save_log, update_log
 from . applier import reject, is_cleaned
+from . batch import apply_batch
 from . import report
\ No newline at end of file
@@ -24,12 +24,14 @@
 from warnings import warn
 
 import mne
+import numpy as np
 from mne.utils import logger
 
 from .io import (
     _check_epochs_params,
     _check_ica_params,
     _get_json_fname,
+    _load_log,
     read_log,
 )
 
@@ -44,8 +46,9 @@ def is_cleaned(path, kind):
         return False
 
     logger.info(f"Checking if cleaned in {json_fname}")
-    logs = read_log(path.parent)
-    t_log = logs[kind]
+    # Plain read: no need to complete or save the log to answer this
+    logs = _load_log(json_fname)
+    t_log = logs.get(kind, {})
     if path.name not in t_log:
         logger.info(f"No log found for {path.name}. Not cleaned.")
         return False
@@ -65,12 +68,12 @@ def reject(path, inst, required=False):
             "Missing eeg_cleaner.json. Did you clean this subject?"
         )
 
-    logs = read_log(path)
+    logs = read_log(path, json_fname=json_fname)
     if isinstance(inst, mne.io.BaseRaw):
         fname = inst.filenames[0].name
         t_log = logs["raws"].get(fname, {})
         old_bads = t_log.get("bads", [])
-        mix_bads = list(set(old_bads + inst.info["bads"]))
+        mix_bads = list(dict.fromkeys((*old_bads, *inst.info["bads"])))
         inst.info["bads"] = mix_bads
         logger.info(
             f"Setting previous bad channels {inst.info['bads']}"
@@ -81,21 +84,17 @@ def reject(path, inst, required=False):
         t_log = logs["epochs"].get(fname, {})
         _check_epochs_params(inst, t_log)
         old_bads = t_log.get("bads", [])
-        mix_bads = list(set(old_bads + inst.info["bads"]))
+        mix_bads = list(dict.fromkeys((*old_bads, *inst.info["bads"])))
         inst.info["bads"] = mix_bads
         logger.info(
             f"Setting previous bad channels {inst.info['bads']}"
         )
 
-        prev_selection = t_log.get("selection", inst.selection)
-        to_drop = [x for x in inst.selection if x not in prev_selection]
-        drop_idx = []
-        cur_idx = 0
-        for i_epoch, dlog in enumerate(inst.drop_log):
-            if len(dlog) == 0:
-                if i_epoch in to_drop:
-                    drop_idx.append(cur_idx)
-                cur_idx += 1
+        prev_selection = np.asarray(t_log.get("selection", inst.selection))
+        mask = ~np.isin(inst.selection, prev_selection, assume_unique=True)
+        to_drop = inst.selection[mask]
+        # Positions of the epochs to drop within the current selection
+        drop_idx = np.flatnonzero(mask).tolist()
         logger.info("Dropping previous bad epochs {}".format(to_drop))
         inst.drop(drop_idx, reason="Inspection")
     elif isinstance(inst, mne.preprocessing.ICA):
@@ -0,0 +1,79 @@
+# NICE-EEG Cleaner
+# Copyright (C) 2019 - Authors of NICE-EEG-Cleaner
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# You can be released from the requirements of the license by purchasing a
+# commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities as mentioned in the GNU Affero General Public
+# License version 3 without disclosing the source code of your own
+# applications.
+#
+
+from mne.utils import logger
+
+from . import io as cleaner_io
+from .applier import reject
+
+
+def _reject_pair(pair):
+    # Workers may share a subject directory, lock the logs (only while
+    # running this task, the worker may be the caller's own process)
+    with cleaner_io._locked_logs():
+        return reject(*pair)
+
+
+def _map_reject(client, pairs):
+    # reject modifies its input, so it is not pure: this also avoids dask
+    # hashing the instances (and their data) to merge identical tasks
+    return client.gather(client.map(_reject_pair, pairs, pure=False))
+
+
+def apply_batch(pairs, client=None, n_workers=None):
+    """
+    Apply the previously selected rejection to many instances in parallel.
+
+    Each element of pairs holds the arguments to `reject`, i.e.
+    (path, inst) or (path, inst, required). The instances are sent to the
+    dask workers and the cleaned copies are returned, in the same order.
+    Always use the returned instances: the inputs are only modified when
+    the client runs the tasks in this process (e.g. processes=False).
+
+    Only bads, dropped epochs and excluded components are set, so the
+    data itself is not needed. Load raws and epochs with preload=False to
+    avoid sending the data to the workers and back.
+
+    Reading the logs takes no lock, so read-only data directories work.
+    Only creating a missing log locks it, which leaves an
+    eeg_cleaner.json.lock file next to it.
+
+    If client is None, a local cluster with n_workers processes is started
+    and closed for this call. Pass an existing dask.distributed.Client to
+    reuse it across calls.
+    """
+    pairs = list(pairs)
+    logger.info(f"Applying rejection to {len(pairs)} instances")
+    if client is not None:
+        return _map_reject(client, pairs)
+
+    try:
+        from dask.distributed import Client
+    except ImportError as e:
+        raise ImportError(
+            "apply_batch requires dask[distributed] to be installed"
+        ) from e
+
+    # One thread per worker, otherwise MNE and BLAS oversubscribe the CPUs
+    with Client(n_workers=n_workers, threads_per_worker=1) as client:
+        return _map_reject(client, pairs)
@@ -20,7 +20,12 @@
 # License version 3 without disclosing the source code of your own
 # applications.
 #
+import contextlib
 import json
+import os
+import sys
+import threading
+from collections import OrderedDict
 from pathlib import Path
 
 import mne
@@ -28,14 +33,123 @@ import numpy as np
 from mne.utils import logger
 
 
+try:
+    import orjson
+
+    _USE_ORJSON = True
+except ImportError:
+    _USE_ORJSON = False
+
+
+_GIT_HASH_CACHE = None
+
+# Drop log reasons of epochs rejected by hand
+_MANUAL_DROP_REASONS = frozenset(("Inspection", "USER"))
+
+# Lock the logs while updating and writing them. Enabled per thread by
+# cleaner.batch (see _locked_logs), so parallel workers sharing a log do
+# not lose updates.
+_LOCKING = threading.local()
+_LOCKS = {}
+
+# Last used logs, keyed by absolute json path: [token, content, parsed].
+# The token is (st_mtime_ns, st_size, st_ino), os.replace changes the inode
+# on every write. The parsed logs are built lazily and only handed to
+# read-only callers.
+_LOG_CACHE = OrderedDict()
+_LOG_CACHE_SIZE = 16
+
+
+def _read_git_hash(t_path):
+    """Read the full HEAD hash from the .git folder, without git.
+
+    Returns None if it can not be read or if the repository has tags (in
+    which case `git describe` would not return a plain hash).
+    """
+    git_dir = None
+    for t_dir in (t_path, *t_path.parents):
+        if (t_dir / ".git").exists():
+            git_dir = t_dir / ".git"
+            break
+    # Worktrees and submodules use a .git file, leave those to git
+    if git_dir is None or not git_dir.is_dir():
+        return None
+    try:
+        packed_fname = git_dir / "packed-refs"
+        packed = packed_fname.read_text() if packed_fname.exists() else ""
+        tags_dir = git_dir / "refs" / "tags"
+        if "refs/tags/" in packed or (
+            tags_dir.is_dir() and any(tags_dir.iterdir())
+        ):
+            return None
+        head = (git_dir / "HEAD").read_text().strip()
+        if head.startswith("ref: "):
+            ref = head[5:]
+            ref_fname = git_dir / ref
+            if ref_fname.exists():
+                head = ref_fname.read_text().strip()
+            else:
+                packed_refs = dict(
+                    line.split(" ", 1)[::-1]
+                    for line in packed.splitlines()
+                    if " " in line and not line.startswith("#")
+                )
+                if ref not in packed_refs:
+                    return None
+                head = packed_refs[ref]
+    except OSError:
+        return None
+    return head
+
+
 def _get_git_hash():
-    import subprocess
+    """Get the git hash of the cleaner (computed only once per process)."""
+    global _GIT_HASH_CACHE
+    if _GIT_HASH_CACHE is None:
+        t_path = Path(__file__).parent.resolve()
+        label = _read_git_hash(t_path)
+        if label is None:
+            import subprocess
+
+            try:
+                label = (
+                    subprocess.check_output(
+                        ["git", "-C", t_path, "describe", "--always"]
+                    )
+                    .strip()
+                    .decode()
+                )
+            except (subprocess.CalledProcessError, FileNotFoundError):
+                label = "unknown"
+        _GIT_HASH_CACHE = label
+    return _GIT_HASH_CACHE
+
+
+def _same_version(prev_hash, git_hash):
+    # Hashes read from .git are full, while `git describe` abbreviates them
+    # to a length that depends on the repository, so match prefixes.
+    if not prev_hash or not git_hash:
+        return prev_hash == git_hash
+    return prev_hash.startswith(git_hash) or git_hash.startswith(prev_hash)
 
-    t_path = Path(__file__).parent.resolve()
-    label = subprocess.check_output(
-        ["git", "-C", t_path, "describe", "--always"]
-    ).strip()
-    return label.decode()
+
+def _loads(content):
+    if _USE_ORJSON:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def _dumps(logs, pretty=False):
+    if _USE_ORJSON:
+        option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(logs, option=option)
+    if pretty:
+        return json.dumps(logs, indent=2, ensure_ascii=False).encode()
+    return json.dumps(
+        logs, separators=(",", ":"), ensure_ascii=False
+    ).encode()
 
 
 def _get_json_fname(path):
@@ -43,49 +157,186 @@ def _get_json_fname(path):
         path = Path(path)
     if path.is_file():
         path = path.parent
-    json_fname = path / "eeg_cleaner.json"
+    # Made absolute (no syscalls) to be used as cache and lock key
+    json_fname = path.absolute() / "eeg_cleaner.json"
     return json_fname
 
 
-def read_log(path):
+def _stat_token(json_fname):
+    st = json_fname.stat()
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def _cache_get(json_fname):
+    cached = _LOG_CACHE.get(json_fname)
+    if cached is not None:
+        with contextlib.suppress(KeyError):
+            _LOG_CACHE.move_to_end(json_fname)
+    return cached
+
+
+def _cache_set(json_fname, cached):
+    _LOG_CACHE[json_fname] = cached
+    with contextlib.suppress(KeyError):
+        _LOG_CACHE.move_to_end(json_fname)
+        while len(_LOG_CACHE) > _LOG_CACHE_SIZE:
+            _LOG_CACHE.popitem(last=False)
+
+
+def _cached_log(json_fname):
+    """Get the cache entry of an existing json file, refreshed if stale.
+
+    Raises FileNotFoundError if the file does not exist.
     """
-    Read the json file if exists, otherwise, create an "empty" file.
+    token = _stat_token(json_fname)
+    cached = _cache_get(json_fname)
+    if cached is None or cached[0] != token:
+        cached = [token, json_fname.read_bytes(), None]
+        _cache_set(json_fname, cached)
+    return cached
+
+
+def _load_log(json_fname):
+    """Parse an existing json file, using the cache if it is up to date.
+
+    The returned dict is shared with the cache and must not be modified.
     """
-    json_fname = _get_json_fname(path)
-    if json_fname.exists():
-        with open(json_fname, "r") as f:
-            logs = json.load(f)
-    else:
-        logs = {}
+    cached = _cached_log(json_fname)
+    if cached[2] is None:
+        cached[2] = _intern_logs(_loads(cached[1]))
+    return cached[2]
+
+
+def _intern_logs(logs):
+    """Intern file and channel names, which repeat across entries.
+
+    Only worth it for the long-lived logs kept in the cache, not for the
+    short-lived copies returned by read_log.
+    """
+    for kind in ("raws", "epochs", "icas"):
+        t_logs = logs.get(kind)
+        if not isinstance(t_logs, dict):
+            continue
+        logs[kind] = {sys.intern(k): v for k, v in t_logs.items()}
+        for t_log in logs[kind].values():
+            if "bads" in t_log:
+                t_log["bads"] = [sys.intern(x) for x in t_log["bads"]]
+            ch_names = t_log.get("params", {}).get("ch_names")
+            if ch_names is not None:
+                t_log["params"]["ch_names"] = [sys.intern(x) for x in ch_names]
+    return logs
+
+
+def _write_atomic(fname, content):
+    """Write content to fname, returning the stat token of the new file."""
+    # Write to a temporary file and rename it, so a crash while writing
+    # does not leave a corrupted file behind. The temporary name is unique
+    # per process and thread, so concurrent writers do not clash.
+    tmp_fname = fname.with_name(
+        f".{fname.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+    )
+    try:
+        tmp_fname.write_bytes(content)
+        # Inode and mtime are kept by the rename. Taking the token before
+        # avoids pairing it with the file of a concurrent writer.
+        token = _stat_token(tmp_fname)
+        os.replace(tmp_fname, fname)
+    except BaseException:
+        tmp_fname.unlink(missing_ok=True)
+        raise
+    return token
 
+
+@contextlib.contextmanager
+def _locked_logs():
+    """Enable log locking in the current thread, within the context."""
+    prev = getattr(_LOCKING, "enabled", False)
+    _LOCKING.enabled = True
+    try:
+        yield
+    finally:
+        _LOCKING.enabled = prev
+
+
+def _log_lock(json_fname):
+    """Get a (re-entrant) lock for the log file, if locking is enabled."""
+    if not getattr(_LOCKING, "enabled", False):
+        return contextlib.nullcontext()
+    from filelock import FileLock
+
+    # Share one lock object per file, a second one would deadlock
+    if json_fname not in _LOCKS:
+        _LOCKS.setdefault(json_fname, FileLock(f"{json_fname}.lock"))
+    return _LOCKS[json_fname]
+
+
+def _read_fresh_log(json_fname):
+    try:
+        content = _cached_log(json_fname)[1]
+    except FileNotFoundError:
+        return {}
+    # Parse a fresh copy, callers modify it
+    return _loads(content)
+
+
+def _add_missing_keys(logs):
+    """Add the keys needed in the log. Returns True if any was missing."""
+    dirty = False
     if "raws" not in logs:
         logs["raws"] = {}
+        dirty = True
     if "epochs" not in logs:
         logs["epochs"] = {}
+        dirty = True
     if "icas" not in logs:
         logs["icas"] = {}
-    git_hash = _get_git_hash()
+        dirty = True
     if "config" not in logs:
-        logs["config"] = {"version": git_hash}
-    else:
-        prev_hash = logs["config"]["version"]
-        if prev_hash != git_hash:
-            logger.warning(
-                "The specified subject was cleaned with a previous "
-                f"version of EEG cleaner. ({prev_hash}). The new version "
-                f"({git_hash}) might fail."
-            )
+        logs["config"] = {"version": _get_git_hash()}
+        dirty = True
+    return dirty
 
-    save_log(path, logs)
+
+def read_log(path, json_fname=None):
+    """
+    Read the json file if exists, otherwise, create an "empty" file.
+
+    If json_fname is given (as returned by _get_json_fname), it is used
+    instead of computing it from path.
+    """
+    if json_fname is None:
+        json_fname = _get_json_fname(path)
+    logs = _read_fresh_log(json_fname)
+    if _add_missing_keys(logs):
+        # Only lock (and write) if we had to add missing keys. Read again
+        # once locked, the log may have been written in the meantime.
+        with _log_lock(json_fname):
+            logs = _read_fresh_log(json_fname)
+            if _add_missing_keys(logs):
+                save_log(path, logs, json_fname=json_fname)
+
+    prev_hash = logs["config"]["version"]
+    git_hash = _get_git_hash()
+    if not _same_version(prev_hash, git_hash):
+        logger.warning(
+            "The specified subject was cleaned with a previous "
+            f"version of EEG cleaner. ({prev_hash}). The new version "
+            f"({git_hash}) might fail."
+        )
 
     return logs
 
 
-def save_log(path, logs):
+def save_log(path, logs, json_fname=None, pretty=False):
     """
     Save the json file, ensuring all the needed keys are there
+
+    If json_fname is given (as returned by _get_json_fname), it is used
+    instead of computing it from path.
+    If pretty is True, the json file is indented to ease reading it.
     """
-    json_fname = _get_json_fname(path)
+    if json_fname is None:
+        json_fname = _get_json_fname(path)
 
     if "raws" not in logs:
         logs["raws"] = {}
@@ -98,54 +349,77 @@ def save_log(path, logs):
         logs["config"] = {"version": git_hash}
     else:
         prev_hash = logs["config"]["version"]
-        if prev_hash != git_hash:
+        if not _same_version(prev_hash, git_hash):
             logger.warning(
                 "The specified subject was cleaned with a previous "
                 f"version of EEG cleaner. ({prev_hash}). The new version "
                 f"({git_hash}) might fail."
             )
-    with open(json_fname, "w") as f:
-        json.dump(logs, f)
+    with _log_lock(json_fname):
+        content = _dumps(logs, pretty=pretty)
+        # Skip writing if the content did not change
+        try:
+            unchanged = _cached_log(json_fname)[1] == content
+        except FileNotFoundError:
+            unchanged = False
+        if unchanged:
+            return
+
+        token = _write_atomic(json_fname, content)
+        _cache_set(json_fname, [token, content, None])
 
 
 def update_log(path, inst):
     """
     Update the log and save the json file
+
+    Concurrent updates of the same log are only safe when log locking is
+    enabled, as done by cleaner.batch.apply_batch. In that case, an
+    eeg_cleaner.json.lock file is left next to the log (removing it while
+    another process waits for it would break the lock).
     """
     logger.info(f"Updating log for {path}")
-    logs = read_log(path)
-    if isinstance(inst, mne.io.BaseRaw):
-        fname = inst.filenames[0].name
-        t_log = logs["raws"].get(fname, {})
-        t_log["bads"] = inst.info["bads"]
-        logger.info(f"Updating bad channels {t_log['bads']}")
-        if fname not in logs["raws"]:
-            logs["raws"][fname] = t_log
-    elif isinstance(inst, mne.BaseEpochs):
-        fname = inst.filename.name
-        t_log = logs["epochs"].get(fname, {})
-        _check_epochs_params(inst, t_log)
-        t_log["bads"] = inst.info["bads"]
-        logger.info(f"Updating bad channels {t_log['bads']}")
-
-        t_log["selection"] = inst.selection.tolist()
-        dropped = [
-            i
-            for i, x in enumerate(inst.drop_log)
-            if "Inspection" in x or "USER" in x
-        ]
-        logger.info(f"Updating bad epochs {dropped}")
-
-        if fname not in logs["epochs"]:
-            logs["epochs"][fname] = t_log
-    elif isinstance(inst, mne.preprocessing.ICA):
-        fname = path.name
-        t_log = logs["icas"].get(fname, {})
-        _check_ica_params(inst, t_log)
-        t_log["exclude"] = inst.exclude
-        if fname not in logs["icas"]:
-            logs["icas"][fname] = t_log
-    save_log(path, logs)
+    json_fname = _get_json_fname(path)
+    with _log_lock(json_fname):
+        logs = read_log(path, json_fname=json_fname)
+        if isinstance(inst, mne.io.BaseRaw):
+            fname = inst.filenames[0].name
+            t_log = logs["raws"].get(fname, {})
+            t_log["bads"] = inst.info["bads"]
+            logger.info(f"Updating bad channels {t_log['bads']}")
+            if fname not in logs["raws"]:
+                logs["raws"][fname] = t_log
+        elif isinstance(inst, mne.BaseEpochs):
+            fname = inst.filename.name
+            t_log = logs["epochs"].get(fname, {})
+            _check_epochs_params(inst, t_log)
+            t_log["bads"] = inst.info["bads"]
+            logger.info(f"Updating bad channels {t_log['bads']}")
+
+            # orjson serializes (C contiguous) numpy arrays directly, json
+            # needs a list. Sliced epochs keep a non-contiguous selection.
+            t_log["selection"] = (
+                np.ascontiguousarray(inst.selection)
+                if _USE_ORJSON
+                else inst.selection.tolist()
+            )
+            dropped = [
+                i
+                for i, x in enumerate(inst.drop_log)
+                if not _MANUAL_DROP_REASONS.isdisjoint(x)
+            ]
+            logger.info(f"Updating bad epochs {dropped}")
+
+            if fname not in logs["epochs"]:
+                logs["epochs"][fname] = t_log
+        elif isinstance(inst, mne.preprocessing.ICA):
+            fname = path.name
+            t_log = logs["icas"].get(fname, {})
+            _check_ica_params(inst, t_log)
+            t_log["exclude"] = inst.exclude
+            if fname not in logs["icas"]:
+                logs["icas"][fname] = t_log
+        save_log(path, logs, json_fname=json_fname)
 
 
 def _check_epochs_params(epochs, t_log):
@@ -170,37 +444,40 @@ def _check_epochs_params(epochs, t_log):
         # Check events (saved events is subset of epochs.events)
         this_selection = epochs.selection
         prev_selection = t_log.get("selection", np.arange(len(epochs)))
-        inter = np.intersect1d(this_selection, prev_selection)
-        this_events = epochs.events[:, 0].tolist()
-        to_check = [
-            this_events[i] for i, x in enumerate(this_selection) if x in inter
-        ]
-        prev_events = t_log["params"]["events"]
-        if not all(x in prev_events for x in to_check):
+        inter = np.intersect1d(
+            this_selection, prev_selection, assume_unique=True
+        )
+        this_events = epochs.events[:, 0]
+        mask = np.isin(this_selection, inter, assume_unique=True)
+        to_check = this_events[mask]
+        prev_events = np.asarray(t_log["params"]["events"])
+        if not np.isin(to_check, prev_events).all():
             raise ValueError("Epochs event samples do not match")
 
 
+_ICA_PARAMS_ERRORS = {
+    "ch_names": "ICA channels names do not match.",
+    "fit_params": "ICA fit params do not match.",
+    "n_components": "ICA number of components do not match.",
+    "highpass": "ICA highpass filter do not match.",
+    "lowpass": "ICA lowpass filter do not match.",
+    "sfreq": "ICA sample frequency do not match.",
+}
+
+
 def _check_ica_params(ica, t_log):
+    current = {
+        "ch_names": ica.ch_names,
+        "fit_params": ica.fit_params,
+        "n_components": ica.n_components,
+        "highpass": ica.info["highpass"],
+        "lowpass": ica.info["lowpass"],
+        "sfreq": ica.info["sfreq"],
+    }
     if "params" not in t_log:
-        t_log["params"] = {
-            "ch_names": ica.ch_names,
-            "fit_params": ica.fit_params,
-            "n_components": ica.n_components,
-            "highpass": ica.info["highpass"],
-            "lowpass": ica.info["lowpass"],
-            "sfreq": ica.info["sfreq"],
-        }
-    else:
-        if ica.ch_names != t_log["params"]["ch_names"]:
-            raise ValueError("ICA channels names do not match.")
-        if ica.fit_params != t_log["params"]["fit_params"]:
-            raise ValueError("ICA fit params do not match.")
-
-        if ica.n_components != t_log["params"]["n_components"]:
-            raise ValueError("ICA number of components do not match.")
-        if ica.info["highpass"] != t_log["params"]["highpass"]:
-            raise ValueError("ICA highpass filter do not match.")
-        if ica.info["lowpass"] != t_log["params"]["lowpass"]:
-            raise ValueError("ICA lowpass filter do not match.")
-        if ica.info["sfreq"] != t_log["params"]["sfreq"]:
-            raise ValueError("ICA sample frequency do not match.")
+        t_log["params"] = current
+    elif current != t_log["params"]:
+        # Report the first parameter that differs
+        for key, msg in _ICA_PARAMS_ERRORS.items():
+            if current[key] != t_log["params"].get(key):
+                raise ValueError(msg)
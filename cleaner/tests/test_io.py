@@ -0,0 +1,56 @@
+# NICE-EEG Cleaner
+# Copyright (C) 2019 - Authors of NICE-EEG-Cleaner
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# You can be released from the requirements of the license by purchasing a
+# commercial license. Buying such a license is mandatory as soon as you
+# develop commercial activities as mentioned in the GNU Affero General Public
+# License version 3 without disclosing the source code of your own
+# applications.
+#
+import mne
+import numpy as np
+import pytest
+
+from cleaner import read_log, update_log
+
+
+def _make_epochs(tmp_path):
+    n_epochs = 10
+    info = mne.create_info(["EEG1", "EEG2"], 100.0, "eeg")
+    data = np.random.RandomState(42).randn(n_epochs, 2, 50)
+    events = np.array([[100 * (i + 1), 0, 1] for i in range(n_epochs)])
+    epochs = mne.EpochsArray(data, info, events=events, tmin=-0.1)
+    fname = tmp_path / "test-epo.fif"
+    epochs.save(fname)
+    return fname, mne.read_epochs(fname)
+
+
+@pytest.mark.parametrize(
+    "key", [slice(None, None, 2), [0, 2, 3, 7]], ids=["sliced", "indexed"]
+)
+def test_update_log_epochs_subset(tmp_path, key):
+    """Test update_log with sliced and indexed epochs."""
+    fname, epochs = _make_epochs(tmp_path)
+    epochs = epochs[key]
+    update_log(fname, epochs)
+
+    logs = read_log(tmp_path)
+    t_log = logs["epochs"][fname.name]
+    assert t_log["selection"] == epochs.selection.tolist()
+    assert t_log["params"]["events"] == epochs.events[:, 0].tolist()
+
+    # Updating again validates against the saved log
+    update_log(fname, epochs)
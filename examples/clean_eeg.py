@@ -61,4 +61,17 @@ ica_fname = epochs_fname.replace('-ica-epo.fif', '-epo-ica.fif')
 ica.save(ica_fname)
 
 
-# %run 3_clean_ica.py --path='/Users/fraimondo/data/lg_controls/subjects/jaco/test-ica-epo.fif' --icaname='auto'
\ No newline at end of file
+# %run 3_clean_ica.py --path='/Users/fraimondo/data/lg_controls/subjects/jaco/test-ica-epo.fif' --icaname='auto'
+
+# Apply the cleaning of many subjects in parallel (requires dask). The
+# returned epochs are cleaned copies, the ones passed in are not modified.
+from dask.distributed import Client
+
+subjects = ['jaco', 'lola']
+epochs_fnames = [
+    f'/Users/fraimondo/data/lg_controls/subjects/{x}/test-ica-epo.fif'
+    for x in subjects]
+all_epochs = [mne.read_epochs(x, preload=False) for x in epochs_fnames]
+with Client(n_workers=2, threads_per_worker=1) as client:
+    all_epochs = cleaner.apply_batch(
+        zip(epochs_fnames, all_epochs), client=client)